@@ -1,53 +1,82 @@
 import asyncio
-import contextlib
 import functools
 import sys
 import traceback
 
 from codeop import CommandCompiler
-from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
 
 
 __all__ = ["start_manhole"]
 
 
 class StatefulCommandCompiler(CommandCompiler):
-    """A command compiler that buffers input until a full command is available."""
+    """A command compiler that buffers input until a full command is available.
+
+    Single line commands are cached, as people tend to type the same few
+    commands over and over again in a manhole.
+    """
+
+    cache_size = 128
 
     def __init__(self):
         super().__init__()
-        self.buf = BytesIO()
+        self._cache = {}
+        # each line is decoded once as it arrives, rather than re-decoding
+        # the whole buffer every time another line is added
+        self.parts = []
 
     def is_partial_command(self):
-        return bool(self.buf.getvalue())
+        return bool(self.parts)
 
     def __call__(self, source, **kwargs):
-        buf = self.buf
-        if self.is_partial_command():
-            buf.write(b"\n")
-        buf.write(source)
+        key = None
+        if not self.parts and not kwargs:
+            # __future__ imports change how later commands compile. source
+            # may be a (possibly writable) memoryview, so key on a bytes copy
+            key = (bytes(source), self.compiler.flags)
+            codeobj = self._cache.pop(key, None)
+            if codeobj is not None:
+                self._cache[key] = codeobj
+                return codeobj
+
+        self.parts.append(str(source, "utf8"))
 
-        code = self.buf.getvalue().decode("utf8")
+        code = "\n".join(self.parts)
 
         codeobj = super().__call__(code, **kwargs)
 
         if codeobj:
             self.reset()
+            if key is not None:
+                self._cache[key] = codeobj
+                if len(self._cache) > self.cache_size:
+                    del self._cache[next(iter(self._cache))]
         return codeobj
 
     def reset(self):
-        self.buf.seek(0)
-        self.buf.truncate(0)
+        self.parts.clear()
 
 
 class InteractiveInterpreter:
     """An interactive asynchronous interpreter."""
 
+    line_limit = 2**16
+    # pending output is flushed once it grows past this, even mid-paste
+    output_limit = 2**16
+
     def __init__(self, namespace, banner, loop):
         self.namespace = namespace
         self.banner = self.get_banner(banner)
         self.compiler = StatefulCommandCompiler()
         self.loop = loop
+        self._inbuf = bytearray()
+        # output waiting to be written along with the next prompt
+        self._outbuf = bytearray()
+        self._stdout_buf = StringIO()
+        # encoded prompts, set up by _setup_prompts
+        self._ps1 = self._ps2 = None
 
     def get_banner(self, banner):
         if isinstance(banner, bytes):
@@ -70,16 +99,33 @@ class InteractiveInterpreter:
         """When an exception has occurred, write the traceback to the user."""
         self.compiler.reset()
 
-        exc = traceback.format_exc()
-        self.writer.write(exc.encode("utf8"))
+        writer = self.writer
+
+        # written along with any pending output in one go, rather than a
+        # write per traceback chunk
+        out = self._outbuf
+        exc = traceback.TracebackException(*sys.exc_info())
+        for chunk in exc.format():
+            out += chunk.encode("utf8")
+        writer.write(bytes(out))
+        del out[:]
 
-        await self.writer.drain()
+        await writer.drain()
 
     async def attempt_exec(self, codeobj, namespace):
-        with contextlib.redirect_stdout(StringIO()) as buf:
+        buf = self._stdout_buf
+        buf.seek(0)
+        buf.truncate(0)
+
+        old_stdout = sys.stdout
+        sys.stdout = buf
+        try:
             value = await self._real_exec(codeobj, namespace)
+        finally:
+            sys.stdout = old_stdout
 
-        return value, buf.getvalue()
+        # most commands print nothing, skip copying out an empty string
+        return value, buf.getvalue() if buf.tell() else ""
 
     async def _real_exec(self, codeobj, namespace):
         return eval(codeobj, namespace)
@@ -87,14 +133,18 @@ class InteractiveInterpreter:
     async def handle_one_command(self):
         """Process a single command. May have many lines."""
 
+        # output and the following prompt are collected together, so each
+        # command costs a single write and drain
+        out = self._outbuf
+
         while True:
-            await self.write_prompt()
+            await self.write_prompt(out)
             codeobj = await self.read_command()
 
             if codeobj is not None:
-                await self.run_command(codeobj)
+                await self.run_command(codeobj, out)
 
-    async def run_command(self, codeobj):
+    async def run_command(self, codeobj, out=None):
         """Execute a compiled code object, and write the output back to the client."""
         try:
             value, stdout = await self.attempt_exec(codeobj, self.namespace)
@@ -102,17 +152,61 @@ class InteractiveInterpreter:
             await self.send_exception()
             return
         else:
-            await self.send_output(value, stdout)
+            await self.send_output(value, stdout, out)
 
-    async def write_prompt(self):
+    async def write_prompt(self, out=None):
+        """Write the prompt, along with any output collected in `out`."""
         writer = self.writer
 
+        if out is None:
+            out = bytearray()
+
+        if self._ps1 is None:
+            self._setup_prompts()
+
         if self.compiler.is_partial_command():
-            writer.write(sys.ps2.encode("utf8"))
+            out += self._ps2
         else:
-            writer.write(sys.ps1.encode("utf8"))
+            out += self._ps1
 
-        await writer.drain()
+        # more lines are already buffered, so hold on to the output until
+        # we actually need to wait on the client, or there's a lot of it
+        if b"\n" not in self._inbuf or len(out) >= self.output_limit:
+            writer.write(bytes(out))
+            del out[:]
+            await writer.drain()
+
+    async def read_line(self):
+        """Read a single line from the client, including the trailing newline.
+
+        Reads are done in large chunks and split locally, so pasting many
+        lines at once doesn't cost a trip through the event loop per line.
+        Returns b"" when the connection has been lost, raises ValueError if
+        the line is longer than `line_limit`.
+        """
+
+        inbuf = self._inbuf
+
+        while True:
+            end = inbuf.find(b"\n")
+            if end != -1:
+                with memoryview(inbuf) as view:
+                    line = bytes(view[: end + 1])
+                del inbuf[: end + 1]
+                return line
+
+            # same limit asyncio's StreamReader.readline() enforces
+            if len(inbuf) > self.line_limit:
+                inbuf.clear()
+                raise ValueError("Line is longer than {} bytes".format(self.line_limit))
+
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                line = bytes(inbuf)
+                inbuf.clear()
+                return line
+
+            inbuf.extend(chunk)
 
     async def read_command(self):
         """Read a command from the user line by line.
@@ -120,39 +214,54 @@ class InteractiveInterpreter:
         Returns a code object suitable for execution.
         """
 
-        reader = self.reader
-
-        line = await reader.readline()
+        line = await self.read_line()
         if line == b"":  # lost connection
             raise ConnectionResetError()
 
+        # skip the newline to make CommandCompiler work as advertised, using a
+        # memoryview so the line isn't copied again
+        source = memoryview(line)
+        if line.endswith(b"\n"):
+            source = source[:-1]
+
         try:
-            # skip the newline to make CommandCompiler work as advertised
-            codeobj = self.attempt_compile(line.rstrip(b"\n"))
+            codeobj = self.attempt_compile(source)
         except SyntaxError:
             await self.send_exception()
             return
 
         return codeobj
 
-    async def send_output(self, value, stdout):
+    async def send_output(self, value, stdout, out=None):
         """Write the output or value of the expression back to user.
 
         >>> 5
         5
         >>> print('cash rules everything around me')
         cash rules everything around me
+
+        If `out` is given, the output is appended to it instead, to be
+        written along with the next prompt.
         """
 
-        writer = self.writer
+        if value is None and not stdout:
+            return
+
+        if out is None:
+            buf = bytearray()
+        else:
+            buf = out
 
         if value is not None:
-            writer.write("{!r}\n".format(value).encode("utf8"))
+            buf += f"{value!r}\n".encode()
 
         if stdout:
-            writer.write(stdout.encode("utf8"))
+            buf += stdout.encode("utf8")
 
-        await writer.drain()
+        if out is None:
+            writer = self.writer
+            writer.write(bytes(buf))
+            await writer.drain()
 
     def _setup_prompts(self):
         try:
@@ -164,6 +273,10 @@ class InteractiveInterpreter:
         except AttributeError:
             sys.ps2 = "... "
 
+        # the prompts don't change during a session, so only encode them once
+        self._ps1 = sys.ps1.encode("utf8")
+        self._ps2 = sys.ps2.encode("utf8")
+
     async def __call__(self, reader, writer):
         """Main entry point for an interpreter session with a single client."""
 
@@ -172,9 +285,8 @@ class InteractiveInterpreter:
 
         self._setup_prompts()
 
-        if self.banner:
-            writer.write(self.banner)
-            await writer.drain()
+        # sent along with the first prompt
+        self._outbuf += self.banner
 
         while True:
             try:
@@ -196,18 +308,56 @@ class ThreadedInteractiveInterpreter(InteractiveInterpreter):
     Also accepts a timeout, which defaults to five seconds. This won't kill
     the running statement (good luck killing a thread) but it will at least
     yield control back to the manhole.
+
+    Each interpreter runs commands in its own single thread, rather than the
+    loop's default executor, so a slow command only holds up the client that
+    ran it. When a command times out, that thread is abandoned and later
+    commands get a fresh one.
     """
 
     def __init__(self, *args, command_timeout=5, **kwargs):
         super().__init__(*args, **kwargs)
         self.command_timeout = command_timeout
+        self._run_in_executor = self.loop.run_in_executor
+        self._call_later = self.loop.call_later
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        return ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="manhole-{}".format(id(self))
+        )
+
+    async def __call__(self, reader, writer):
+        try:
+            await super().__call__(reader, writer)
+        finally:
+            self._executor.shutdown(wait=False)
 
     async def _real_exec(self, codeobj, namespace):
-        task = self.loop.run_in_executor(None, eval, codeobj, namespace)
-        if self.command_timeout:
-            task = asyncio.wait_for(task, self.command_timeout)
-        value = await task
-        return value
+        fut = self._run_in_executor(self._executor, eval, codeobj, namespace)
+        if not self.command_timeout:
+            return await fut
+
+        timed_out = False
+
+        def on_timeout():
+            nonlocal timed_out
+            timed_out = True
+            fut.cancel()
+
+        # cheaper than asyncio.wait_for, which wraps the future in another task
+        timer = self._call_later(self.command_timeout, on_timeout)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if timed_out:
+                # the command is still running, don't queue anything behind it
+                self._executor.shutdown(wait=False)
+                self._executor = self._create_executor()
+                raise asyncio.TimeoutError() from None
+            raise
+        finally:
+            timer.cancel()
 
 
 class InterpreterFactory:
@@ -230,13 +380,22 @@ class InterpreterFactory:
         self.loop = loop or asyncio.get_event_loop()
 
     def __call__(self, reader, writer):
+        # This has to be a real copy. eval() only accepts a dict for globals,
+        # and passing a ChainMap as locals instead would hide names defined
+        # in the manhole from functions defined in the manhole.
         interpreter = self.interpreter_class(
             *self.args,
             loop=self.loop,
             namespace=self.namespace if self.shared else dict(self.namespace),
             **self.kwargs
         )
-        return asyncio.ensure_future(interpreter(reader, writer), loop=self.loop)
+        coro = interpreter(reader, writer)
+        if sys.version_info >= (3, 12) and self.loop.get_task_factory() is None:
+            # run straight up to the first read, rather than waiting a loop
+            # iteration to even send the banner. Not done with a custom task
+            # factory, as that would bypass it.
+            return asyncio.Task(coro, loop=self.loop, eager_start=True)
+        return asyncio.ensure_future(coro, loop=self.loop)
 
 
 def start_manhole(
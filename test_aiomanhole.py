@@ -2,6 +2,7 @@ import asyncio
 from contextlib import contextmanager
 import os
 import shutil
+import sys
 import tempfile
 
 from io import BytesIO
@@ -9,7 +10,13 @@ from unittest import mock
 
 import pytest
 
-from aiomanhole import StatefulCommandCompiler, InteractiveInterpreter, start_manhole
+from aiomanhole import (
+    InteractiveInterpreter,
+    InterpreterFactory,
+    StatefulCommandCompiler,
+    ThreadedInteractiveInterpreter,
+    start_manhole,
+)
 
 
 @pytest.fixture(scope="function")
@@ -26,6 +33,17 @@ def interpreter(loop):
     return s
 
 
+@pytest.fixture(scope="function")
+def threaded_interpreter(loop):
+    s = ThreadedInteractiveInterpreter({}, "", loop, command_timeout=0.05)
+    s.reader = MockStream()
+    s.writer = MockStream()
+
+    yield s
+
+    s._executor.shutdown(wait=False)
+
+
 @pytest.fixture(scope="function")
 def loop():
     loop = asyncio.new_event_loop()
@@ -81,6 +99,7 @@ async def send_command(message, reader, writer, loop):
 class MockStream:
     def __init__(self):
         self.buf = BytesIO()
+        self.pos = 0
 
     def write(self, data):
         self.buf.write(data)
@@ -92,6 +111,13 @@ class MockStream:
         self.buf.seek(0)
         return self.buf.readline()
 
+    async def read(self, n=-1):
+        data = self.buf.getvalue()[self.pos :]
+        if n >= 0:
+            data = data[:n]
+        self.pos += len(data)
+        return data
+
 
 class TestStatefulCommandCompiler:
     def test_one_line(self, compiler):
@@ -109,6 +135,37 @@ class TestStatefulCommandCompiler:
 
         assert compiler(b"import asyncio") is not None
 
+    def test_one_line__cached(self, compiler):
+        f = compiler(b"f = 5")
+        assert compiler(b"f = 5") is f
+        assert compiler(b"f = 6") is not f
+
+    def test_one_line__memoryview(self, compiler):
+        f = compiler(memoryview(b"f = 5\n")[:-1])
+        assert f is not None
+        assert compiler(b"f = 5") is f
+        assert compiler(memoryview(b"f = 5")) is f
+
+    def test_one_line__writable_memoryview(self, compiler):
+        compiler(b"y = 2")
+        f = compiler(memoryview(bytearray(b"x = 1")))
+        assert f is not None
+        assert compiler(memoryview(bytearray(b"x = 1"))) is f
+
+    def test_one_line__cache_is_bounded(self, compiler):
+        for i in range(compiler.cache_size + 10):
+            compiler("f = {}".format(i).encode("utf8"))
+
+        assert len(compiler._cache) == compiler.cache_size
+        assert (b"f = 0", compiler.compiler.flags) not in compiler._cache
+
+    def test_multi_line__not_cached(self, compiler):
+        assert compiler(b"if True:") is None
+        assert compiler(b"    pass") is None
+        assert compiler(b"") is not None
+
+        assert not compiler._cache
+
     MULTI_LINE_1 = [
         b"try:",
         b"    raise Exception",
@@ -233,6 +290,23 @@ class TestInteractiveInterpreter:
         else:
             assert f is not None
 
+    def test_read_command__buffers_multiple_lines(self, interpreter, loop):
+        interpreter.reader.write(b"def foo():\n    return 5\n\n")
+
+        assert loop.run_until_complete(interpreter.read_command()) is None
+        assert loop.run_until_complete(interpreter.read_command()) is None
+        assert loop.run_until_complete(interpreter.read_command()) is not None
+        assert interpreter.reader.pos == len(interpreter.reader.buf.getvalue())
+
+    def test_read_command__raises_on_long_line(self, interpreter, loop):
+        interpreter.reader.write(b"x" * (interpreter.line_limit + 1))
+        pytest.raises(ValueError, loop.run_until_complete, interpreter.read_command())
+        assert interpreter._inbuf == b""
+
+        interpreter.reader.write(b"\nf = 5\n")
+        assert loop.run_until_complete(interpreter.read_line()) == b"\n"
+        assert loop.run_until_complete(interpreter.read_command()) is not None
+
     def test_read_command__raises_on_empty_read(self, interpreter, loop):
         pytest.raises(
             ConnectionResetError, loop.run_until_complete, interpreter.read_command()
@@ -252,6 +326,100 @@ class TestInteractiveInterpreter:
         output = interpreter.writer.buf.getvalue()
         assert output == expected_output
 
+    def test_send_output__nothing_to_send(self, interpreter, loop):
+        interpreter.writer = mock.Mock()
+        loop.run_until_complete(interpreter.send_output(None, ""))
+
+        interpreter.writer.write.assert_not_called()
+        interpreter.writer.drain.assert_not_called()
+
+    def test_pasted_output_is_flushed_in_pieces(self, loop):
+        interpreter = InteractiveInterpreter({}, "", loop)
+        reader = MockStream()
+        reader.write(b"'x' * 40000\n" * 5)
+        writer = MockStream()
+        writer.write = mock.Mock(wraps=writer.write)
+        writer.close = mock.Mock()
+
+        with mock.patch("sys.ps1", ">>> ", create=True):
+            loop.run_until_complete(interpreter(reader, writer))
+
+        writes = [call.args[0] for call in writer.write.call_args_list]
+        assert len(writes) > 2
+        assert all(len(data) < 2 * interpreter.output_limit for data in writes)
+        result = b"'" + b"x" * 40000 + b"'\n>>> "
+        assert writer.buf.getvalue() == b">>> " + result * 5
+
+    def test_send_output__collects_into_buffer(self, interpreter, loop):
+        out = bytearray()
+        loop.run_until_complete(interpreter.send_output(5, "hello", out))
+
+        assert out == b"5\nhello"
+        assert interpreter.writer.buf.getvalue() == b""
+
+    def test_write_prompt__flushes_buffer(self, interpreter, loop):
+        out = bytearray(b"5\n")
+        with mock.patch("sys.ps1", ">>> ", create=True):
+            loop.run_until_complete(interpreter.write_prompt(out))
+
+        assert interpreter.writer.buf.getvalue() == b"5\n>>> "
+        assert out == b""
+
+    def test_send_exception__flushes_pending_output(self, interpreter, loop):
+        interpreter._outbuf += b"5\n>>> "
+        interpreter.writer.write = mock.Mock(wraps=interpreter.writer.write)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            loop.run_until_complete(interpreter.send_exception())
+
+        output = interpreter.writer.buf.getvalue()
+        assert output.startswith(b"5\n>>> Traceback")
+        assert output.endswith(b"ValueError: boom\n")
+        interpreter.writer.write.assert_called_once_with(output)
+        assert interpreter._outbuf == b""
+
+    def test_attempt_exec__captures_stdout(self, interpreter, loop):
+        stdout = sys.stdout
+        for text in ["first", "2nd"]:
+            codeobj = interpreter.attempt_compile(
+                "print({!r})".format(text).encode("utf8")
+            )
+            result = loop.run_until_complete(interpreter.attempt_exec(codeobj, {}))
+            assert result == (None, text + "\n")
+
+        assert sys.stdout is stdout
+
+    def test_attempt_exec__no_stdout(self, interpreter, loop):
+        codeobj = interpreter.attempt_compile(b'print("hello")')
+        loop.run_until_complete(interpreter.attempt_exec(codeobj, {}))
+
+        codeobj = interpreter.attempt_compile(b"x = 5")
+        result = loop.run_until_complete(interpreter.attempt_exec(codeobj, {}))
+        assert result == (None, "")
+
+    def test_attempt_exec__restores_stdout_on_error(self, interpreter, loop):
+        stdout = sys.stdout
+        codeobj = interpreter.attempt_compile(b"1 / 0")
+        pytest.raises(
+            ZeroDivisionError,
+            loop.run_until_complete,
+            interpreter.attempt_exec(codeobj, {}),
+        )
+        assert sys.stdout is stdout
+
+    def test_banner_sent_with_first_prompt(self, loop):
+        interpreter = InteractiveInterpreter({}, "hello\n", loop)
+        writer = MockStream()
+        writer.write = mock.Mock(wraps=writer.write)
+        writer.close = mock.Mock()
+
+        with mock.patch("sys.ps1", ">>> ", create=True):
+            loop.run_until_complete(interpreter(MockStream(), writer))
+
+        writer.write.assert_called_once_with(b"hello\n>>> ")
+        writer.close.assert_called_once_with()
+
     @pytest.mark.parametrize(
         "stdin,expected_output",
         [
@@ -268,3 +436,160 @@ class TestInteractiveInterpreter:
                 send_command(stdin + b"\n", reader, writer, loop)
             )
             assert output == expected_output
+
+
+class TestThreadedInteractiveInterpreter:
+    def test_uses_own_executor(self, threaded_interpreter, loop):
+        interpreter = threaded_interpreter
+        codeobj = interpreter.attempt_compile(
+            b"__import__('threading').current_thread().name"
+        )
+        loop.run_until_complete(interpreter.run_command(codeobj))
+
+        output = interpreter.writer.buf.getvalue()
+        assert output.startswith("'manhole-{}".format(id(interpreter)).encode("utf8"))
+
+    def test_command_timeout(self, threaded_interpreter, loop):
+        interpreter = threaded_interpreter
+        codeobj = interpreter.attempt_compile(b"__import__('time').sleep(0.3)")
+        loop.run_until_complete(interpreter.run_command(codeobj))
+
+        output = interpreter.writer.buf.getvalue()
+        assert output.startswith(b"Traceback")
+        assert b"TimeoutError" in output
+
+    def test_command_after_timeout(self, threaded_interpreter, loop):
+        interpreter = threaded_interpreter
+        executor = interpreter._executor
+        codeobj = interpreter.attempt_compile(b"__import__('time').sleep(0.3)")
+        loop.run_until_complete(interpreter.run_command(codeobj))
+
+        interpreter.writer = MockStream()
+        codeobj = interpreter.attempt_compile(b"1 + 1")
+        loop.run_until_complete(interpreter.run_command(codeobj))
+
+        assert interpreter.writer.buf.getvalue() == b"2\n"
+        assert interpreter._executor is not executor
+        assert executor._shutdown
+
+    def test_cancelled_command_is_not_timeout(self, threaded_interpreter, loop):
+        interpreter = threaded_interpreter
+        interpreter.command_timeout = 5
+        codeobj = interpreter.attempt_compile(b"__import__('time').sleep(0.1)")
+        task = loop.create_task(interpreter._real_exec(codeobj, {}))
+        loop.call_soon(task.cancel)
+
+        pytest.raises(asyncio.CancelledError, loop.run_until_complete, task)
+
+    def test_uses_bound_loop_methods(self, threaded_interpreter, loop):
+        interpreter = threaded_interpreter
+        assert interpreter._run_in_executor == loop.run_in_executor
+        assert interpreter._call_later == loop.call_later
+
+        interpreter._run_in_executor = mock.Mock(wraps=interpreter._run_in_executor)
+        interpreter._call_later = mock.Mock(wraps=interpreter._call_later)
+        namespace = {}
+        codeobj = interpreter.attempt_compile(b"5")
+        loop.run_until_complete(interpreter._real_exec(codeobj, namespace))
+
+        interpreter._run_in_executor.assert_called_once_with(
+            interpreter._executor, eval, codeobj, namespace
+        )
+        assert interpreter._call_later.call_args.args[0] == interpreter.command_timeout
+
+    def test_shuts_down_executor(self, threaded_interpreter, loop):
+        writer = MockStream()
+        writer.close = mock.Mock()
+
+        loop.run_until_complete(threaded_interpreter(MockStream(), writer))
+
+        assert threaded_interpreter._executor._shutdown
+
+
+class TestInterpreterFactory:
+    @pytest.mark.parametrize("shared", [True, False])
+    def test_namespace(self, loop, shared):
+        namespace = {"a": 1}
+        interpreter_class = mock.Mock()
+        factory = InterpreterFactory(
+            interpreter_class, namespace=namespace, shared=shared, loop=loop
+        )
+
+        with mock.patch("asyncio.ensure_future"), mock.patch("asyncio.Task"):
+            factory(MockStream(), MockStream())
+
+        client_namespace = interpreter_class.call_args.kwargs["namespace"]
+        assert client_namespace == namespace
+        assert (client_namespace is namespace) == shared
+
+    def test_starts_task(self, loop):
+        writer = MockStream()
+        writer.close = mock.Mock()
+        factory = InterpreterFactory(InteractiveInterpreter, banner="", loop=loop)
+
+        task = factory(MockStream(), writer)
+
+        assert isinstance(task, asyncio.Task)
+        loop.run_until_complete(task)
+        writer.close.assert_called_once_with()
+
+    @pytest.mark.skipif(sys.version_info < (3, 12), reason="needs eager tasks")
+    def test_starts_task_eagerly(self, loop):
+        writer = MockStream()
+        writer.close = mock.Mock()
+        reader = mock.Mock()
+        reader.read.return_value = asyncio.Future(loop=loop)
+        factory = InterpreterFactory(InteractiveInterpreter, banner="hi\n", loop=loop)
+
+        async def connect():
+            with mock.patch("sys.ps1", ">>> ", create=True):
+                task = factory(reader, writer)
+            # nothing has yielded to the loop yet
+            assert writer.buf.getvalue() == b"hi\n>>> "
+            task.cancel()
+
+        loop.run_until_complete(connect())
+
+    def test_uses_task_factory(self, loop):
+        tasks = []
+
+        def task_factory(loop, coro, **kwargs):
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+            tasks.append(task)
+            return task
+
+        loop.set_task_factory(task_factory)
+        writer = MockStream()
+        writer.close = mock.Mock()
+        factory = InterpreterFactory(InteractiveInterpreter, banner="", loop=loop)
+
+        async def connect():
+            return factory(MockStream(), writer)
+
+        task = loop.run_until_complete(connect())
+        loop.run_until_complete(task)
+
+        assert task in tasks
+        writer.close.assert_called_once_with()
+
+    def test_unshared_namespace__functions_see_client_names(self, loop):
+        namespace = {"a": 1}
+        factory = InterpreterFactory(
+            InteractiveInterpreter,
+            namespace=namespace,
+            shared=False,
+            banner="",
+            loop=loop,
+        )
+        reader = MockStream()
+        reader.write(b"b = 2\ndef f():\n    return a + b\n\nf()\n")
+        writer = MockStream()
+        writer.close = mock.Mock()
+
+        with mock.patch("sys.ps1", ">>> ", create=True), mock.patch(
+            "sys.ps2", "... ", create=True
+        ):
+            loop.run_until_complete(factory(reader, writer))
+
+        assert writer.buf.getvalue() == b">>> >>> ... ... >>> 3\n>>> "
+        assert namespace == {"a": 1}